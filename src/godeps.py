@@ -1,40 +1,53 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import contextlib
 import difflib
-import json
+import hashlib
+import itertools
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
 from pathlib import Path
-from typing import Any, ContextManager, Iterable, Iterator, Literal, NamedTuple, Optional, Self
-
-import pydantic
+from typing import (
+    IO,
+    Any,
+    ContextManager,
+    Iterable,
+    Iterator,
+    Literal,
+    NamedTuple,
+    Optional,
+    Self,
+    TypeVar,
+    cast,
+)
+
+import msgspec
 
 logging.basicConfig(level="DEBUG", format="godeps: %(message)s")
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
 
-class CamelModel(pydantic.BaseModel):
-    """Attributes automatically get CamelCase aliases.
 
-    >>> class GolangModel(CamelModel):
-            some_attribute: str
+class CamelStruct(msgspec.Struct, rename="pascal", frozen=True, gc=False):
+    """Attributes automatically get CamelCase names in JSON.
 
-    >>> GolangModel.parse_obj({"SomeAttribute": "hello"})
-    GolangModel(some_attribute="hello")
-    """
+    >>> class GolangStruct(CamelStruct):
+            some_attribute: str
 
-    class Config:
-        @staticmethod
-        def alias_generator(attr_name: str) -> str:
-            return "".join(word.capitalize() for word in attr_name.split("_"))
+    >>> msgspec.json.decode(b'{"SomeAttribute": "hello"}', type=GolangStruct)
+    GolangStruct(some_attribute='hello')
 
-        allow_population_by_field_name = True
+    Instances are immutable and not tracked by the garbage collector. They never form reference
+    cycles, and tens of thousands of them would otherwise keep triggering full collections.
+    """
 
 
-class Module(CamelModel):
+class Module(CamelStruct):
     """A Go module as returned by the -json option of various commands."""
 
     path: str
@@ -43,11 +56,11 @@ class Module(CamelModel):
     main: bool = False
 
 
-class Package(CamelModel):
+class Package(CamelStruct):
     """A Go package as returned by the -json option of various commands."""
 
     import_path: str
-    module: Optional[Module]
+    module: Optional[Module] = None
     standard: bool = False
     deps: list[str] = []
 
@@ -64,27 +77,34 @@ class NameVersion(NamedTuple):
     @classmethod
     def from_module(cls, module: Module) -> Self:
         """Get the name and version of a Go module."""
-        if not (replace := module.replace):
-            name = module.path
-            version = module.version
-        elif replace.version:
-            name = replace.path
-            version = replace.version
-        else:
-            name = module.path
-            version = replace.path
+        return cls(*_get_name_and_version(module))
+
+
+def _get_name_and_version(module: Module) -> tuple[str, str]:
+    if not (replace := module.replace):
+        name = module.path
+        version = module.version
+    elif replace.version:
+        name = replace.path
+        version = replace.version
+    else:
+        name = module.path
+        version = replace.path
 
-        if not version:
-            raise ValueError(f"versionless module: {module}")
+    if not version:
+        raise ValueError(f"versionless module: {module}")
 
-        return cls(name, version)
+    return name, version
 
 
-def get_names_and_versions(modules: Iterable[Module]) -> list[NameVersion]:
-    return sorted({NameVersion.from_module(module) for module in modules if not module.main})
+def get_names_and_versions(modules: Iterable[Module]) -> list[str]:
+    """Get the sorted, unique name@version strings of the (non-main) modules."""
+    # deduplicate plain tuples first, then format only the unique ones
+    names_and_versions = {_get_name_and_version(module) for module in modules if not module.main}
+    return [f"{name}@{version}" for name, version in sorted(names_and_versions)]
 
 
-def get_module_names_and_versions(packages: Iterable[Package]) -> list[NameVersion]:
+def get_module_names_and_versions(packages: Iterable[Package]) -> list[str]:
     return get_names_and_versions(package.module for package in packages if package.module)
 
 
@@ -104,22 +124,18 @@ class GomodResolver:
 
     def parse_download(self) -> list[Module]:
         """Parse modules from `go mod download -json`."""
-        return list(
-            map(Module.parse_obj, _load_json_stream(self._run_go(["mod", "download", "-json"])))
-        )
+        return list(self._run_go_json(["mod", "download", "-json"], _MODULE_LIST))
 
-    def parse_list_deps(self, pattern: Literal["all", "./..."] = "all") -> list[Package]:
-        """Parse packages from `go list -deps -json ./...` or `go list -deps -json all`."""
-        return list(
-            map(
-                Package.parse_obj,
-                _load_json_stream(
-                    self._run_go(
-                        ["list", "-deps", "-json=ImportPath,Module,Standard,Deps", pattern]
-                    )
-                ),
-            )
-        )
+    def parse_list_deps(
+        self, pattern: Literal["all", "./..."] = "all", include_deps: bool = True
+    ) -> list[Package]:
+        """Parse packages from `go list -deps -json ./...` or `go list -deps -json all`.
+
+        :param include_deps: fill in the deps of each package (by far the largest part of the
+            output, skip it when only the modules are needed)
+        """
+        fields = "ImportPath,Module,Standard,Deps" if include_deps else "ImportPath,Module,Standard"
+        return list(self._run_go_json(["list", "-deps", f"-json={fields}", pattern], _PACKAGE_LIST))
 
     def parse_gomodcache(self) -> list[Module]:
         """Parse modules from the module cache.
@@ -129,16 +145,15 @@ class GomodResolver:
         download_dir = self.gomodcache / "cache" / "download"
 
         def un_exclamation_mark(s: str) -> str:
+            if "!" not in s:  # the common case, no uppercase letters
+                return s
             first, *rest = s.split("!")
             return first + "".join(map(str.capitalize, rest))
 
-        def parse_zipfile_path(zipfile: Path) -> Module:
-            # filepath ends with @v/<version>.zip
-            name = zipfile.relative_to(download_dir).parent.parent.as_posix()
-            version = zipfile.stem
-            return Module(path=un_exclamation_mark(name), version=un_exclamation_mark(version))
-
-        return list(map(parse_zipfile_path, download_dir.rglob("*.zip")))
+        return [
+            Module(path=un_exclamation_mark(name), version=un_exclamation_mark(version))
+            for name, version in _find_module_zips(str(download_dir))
+        ]
 
     def vendor_deps(self) -> None:
         """Run `go mod vendor` to vendor dependencies."""
@@ -149,6 +164,14 @@ class GomodResolver:
 
         :param drop_unused: don't include modules that have no packages in modules.txt
         """
+        return [
+            module
+            for module, has_packages in self.parse_vendor_usage()
+            if has_packages or not drop_unused
+        ]
+
+    def parse_vendor_usage(self) -> list[tuple[Module, bool]]:
+        """Parse modules from vendor/modules.txt, along with whether they have any packages."""
         modules_txt = self.module_dir / "vendor" / "modules.txt"
 
         def parse_module_line(line: str) -> Module:
@@ -173,47 +196,126 @@ class GomodResolver:
         modules: list[Module] = []
         module_has_packages: list[bool] = []
 
-        for line in modules_txt.read_text().splitlines():
-            if line.startswith("# "):  # module line
-                modules.append(parse_module_line(line))
+        # classify lines as bytes, only module lines need to be decoded
+        for line in modules_txt.read_bytes().splitlines():
+            prefix = line[:2]
+            if prefix == b"# ":  # module line
+                modules.append(parse_module_line(line.decode()))
                 module_has_packages.append(False)
-            elif not line.startswith("#"):  # package line
+            elif prefix[:1] != b"#":  # package line
                 if not modules:
-                    raise ValueError(f"no module line found above {line!r}")
+                    raise ValueError(f"no module line found above {line.decode()!r}")
                 module_has_packages[-1] = True
-            elif not line.startswith("## explicit"):  # marker line
-                raise ValueError(f"unrecognized line in modules.txt: {line}")
+            elif not line.startswith(b"## explicit"):  # marker line
+                raise ValueError(f"unrecognized line in modules.txt: {line.decode()}")
 
         def is_wildcard_replacement(module: Module) -> bool:
             return module.replace is not None and not module.version
 
         return [
-            module
+            (module, has_packages)
             for module, has_packages in zip(modules, module_has_packages, strict=True)
-            if not is_wildcard_replacement(module) and (has_packages or not drop_unused)
+            if not is_wildcard_replacement(module)
         ]
 
-    def _run_go(self, go_cmd: list[str]) -> str:
+    def _run_go(self, go_cmd: list[str]) -> bytes:
         cmd = [self.go_executable, *go_cmd]
         p = subprocess.run(
             cmd,
             cwd=self.module_dir,
             env=os.environ | {"GOMODCACHE": str(self.gomodcache)},
             check=True,
-            text=True,
             stdout=subprocess.PIPE,
         )
         return p.stdout
 
+    def _run_go_json(
+        self, go_cmd: list[str], decoder: msgspec.json.Decoder[list[T]]
+    ) -> Iterator[T]:
+        """Run a `go ... -json` command, decode the objects it prints while it's still running."""
+        cmd = [self.go_executable, *go_cmd]
+        with subprocess.Popen(
+            cmd,
+            cwd=self.module_dir,
+            env=os.environ | {"GOMODCACHE": str(self.gomodcache)},
+            stdout=subprocess.PIPE,
+        ) as p:
+            stdout = cast(IO[bytes], p.stdout)
+            try:
+                for chunk in _read_json_stream(stdout):
+                    yield from decoder.decode(_json_stream_to_array(chunk))
+            except msgspec.DecodeError:
+                # if go failed, its partial output is not the real problem
+                stdout.read()
+                if p.wait() != 0:
+                    raise subprocess.CalledProcessError(p.returncode, cmd) from None
+                raise
+            except BaseException:
+                p.kill()
+                raise
+
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+_MODULE_LIST = msgspec.json.Decoder(list[Module])
+_PACKAGE_LIST = msgspec.json.Decoder(list[Package])
 
-def _load_json_stream(json_stream: str) -> Iterator[dict[str, Any]]:
-    decoder = json.JSONDecoder()
-    i = 0
 
-    while i < len(json_stream):
-        data, j = decoder.raw_decode(json_stream, i)
-        i = j + 1
-        yield data
+def _json_stream_to_array(json_stream: bytes) -> bytes:
+    """Turn the concatenated JSON objects printed by `go ... -json` into a JSON array.
+
+    Go prints each object indented, with the closing brace of a top-level object at the start
+    of a line. Newlines inside strings are always escaped, so a newline followed by a closing
+    brace can only ever end a top-level object.
+
+    Leading/trailing whitespace is valid JSON, so the stream doesn't need to be stripped.
+    """
+    return b"[%b]" % b"\n},\n{".join(json_stream.split(b"\n}\n{"))
+
+
+def _read_json_stream(stream: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Read the JSON objects printed by `go ... -json`, yield them in batches as they complete.
+
+    Uses the same top-level object boundary as _json_stream_to_array.
+    """
+    fd = stream.fileno()
+    buf = bytearray()
+
+    while chunk := os.read(fd, chunk_size):
+        # only the new chunk (and the end of the previous one) can contain a new boundary
+        search_from = max(len(buf) - 2, 0)
+        buf += chunk
+        if (end := buf.rfind(b"\n}\n", search_from)) != -1:
+            end += len(b"\n}\n")
+            yield bytes(buf[:end])
+            del buf[:end]
+
+    if buf.strip():
+        yield bytes(buf)
+
+
+def _find_module_zips(download_dir: str) -> Iterator[tuple[str, str]]:
+    """Find the <name>/@v/<version>.zip files in the module cache, yield (name, version).
+
+    Walks the directory tree with os.scandir, which gets the file type of each entry from the
+    directory listing itself rather than a separate stat call.
+    """
+    if not os.path.isdir(download_dir):
+        return
+
+    prefix_len = len(download_dir) + len(os.sep)
+    dirs_to_scan = [download_dir]
+
+    while dirs_to_scan:
+        with os.scandir(dirs_to_scan.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs_to_scan.append(entry.path)
+                elif entry.name.endswith(".zip"):
+                    # path ends with @v/<version>.zip
+                    name_dir = os.path.dirname(os.path.dirname(entry.path))
+                    yield name_dir[prefix_len:], entry.name.removesuffix(".zip")
 
 
 def main() -> None:
@@ -238,6 +340,19 @@ def main() -> None:
         "--deptree", action="store_true", help="print the dependency tree of the *packages* used"
     )
     ap.add_argument("--go", default="go", help="the go executable to use, defaults to 'go'")
+    ap.add_argument(
+        "--cache",
+        action="store_true",
+        help=(
+            "re-use the results of a previous --cache run if go.mod and go.sum haven't changed "
+            "(stored in <output-dir>/.cache/, delete it to invalidate; not used with --vendor)"
+        ),
+    )
+    ap.add_argument(
+        "--pretty-diff",
+        action="store_true",
+        help="print differences as a unified diff (with context) rather than just +/- lines",
+    )
 
     args = ap.parse_args()
 
@@ -256,91 +371,213 @@ def main() -> None:
     with cleanup_context:
         resolver = GomodResolver(module_dir, gomodcache_dir, go_executable)
         if args.vendor:
-            _check_vendor(resolver, output_dir)
+            _check_vendor(resolver, output_dir, args.pretty_diff)
         else:
-            _check_download(resolver, output_dir)
+            _check_download(resolver, output_dir, args.pretty_diff, args.cache)
 
         if args.deptree:
             _print_deptree(resolver)
 
 
-def _check_download(resolver: GomodResolver, output_dir: Path) -> None:
-    log.info("downloading and identifying dependencies")
-    download = get_names_and_versions(resolver.parse_download())
-    gomodcache = get_names_and_versions(resolver.parse_gomodcache())
-    listdeps_all = get_module_names_and_versions(resolver.parse_list_deps(pattern="all"))
-    listdeps_threedot = get_module_names_and_versions(resolver.parse_list_deps(pattern="./..."))
+_DOWNLOAD_RESULTS = (
+    "download.txt",
+    "gomodcache.txt",
+    "listdeps_all.txt",
+    "listdeps_threedot.txt",
+    "download_plus_local_paths.txt",
+)
 
-    _write_results(download, output_dir / "download.txt")
-    _write_results(gomodcache, output_dir / "gomodcache.txt")
-    _write_results(listdeps_all, output_dir / "listdeps_all.txt")
-    _write_results(listdeps_threedot, output_dir / "listdeps_threedot.txt")
 
-    download_plus_local_paths = sorted(set(download).union(listdeps_all))
-    _write_results(download_plus_local_paths, output_dir / "download_plus_local_paths.txt")
+def _check_download(
+    resolver: GomodResolver, output_dir: Path, pretty_diff: bool, use_cache: bool
+) -> None:
+    cache_dir = output_dir / ".cache" / _get_cache_key(resolver) if use_cache else None
+    cache_hit = cache_dir is not None and cache_dir.is_dir()
 
-    if download_diff := _get_diff(map(str, download), map(str, gomodcache)):
+    if cache_dir and cache_hit:
+        log.info("re-using cached results from %s", cache_dir)
+        results = {
+            filename: list(filter(None, (cache_dir / filename).read_text().splitlines()))
+            for filename in _DOWNLOAD_RESULTS
+        }
+    else:
+        results = _identify_downloaded_deps(resolver)
+
+    for filename, result in results.items():
+        _write_results(result, output_dir / filename)
+
+    if cache_dir and not cache_hit:
+        _save_to_cache(output_dir, cache_dir)
+
+    download = results["download.txt"]
+    gomodcache = results["gomodcache.txt"]
+    if download_diff := _get_diff(download, gomodcache, pretty_diff):
         log.info("diffing downloaded modules: identified x actual")
         print(download_diff)
     else:
         log.info("diffing downloaded modules: perfect match")
 
 
-def _check_vendor(resolver: GomodResolver, output_dir: Path) -> None:
+def _identify_downloaded_deps(resolver: GomodResolver) -> dict[str, list[str]]:
+    log.info("downloading and identifying dependencies")
+    download_modules = resolver.parse_download()
+    download = get_names_and_versions(download_modules)
+
+    # once `go mod download` has populated GOMODCACHE, the rest is independent
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        gomodcache_future = executor.submit(resolver.parse_gomodcache)
+        listdeps_all_future = executor.submit(
+            resolver.parse_list_deps, pattern="all", include_deps=False
+        )
+        listdeps_threedot_future = executor.submit(
+            resolver.parse_list_deps, pattern="./...", include_deps=False
+        )
+
+    gomodcache = get_names_and_versions(gomodcache_future.result())
+    listdeps_all_modules = [
+        package.module for package in listdeps_all_future.result() if package.module
+    ]
+    listdeps_all = get_names_and_versions(listdeps_all_modules)
+    listdeps_threedot = get_module_names_and_versions(listdeps_threedot_future.result())
+
+    download_plus_local_paths = get_names_and_versions(
+        itertools.chain(download_modules, listdeps_all_modules)
+    )
+
+    return {
+        "download.txt": download,
+        "gomodcache.txt": gomodcache,
+        "listdeps_all.txt": listdeps_all,
+        "listdeps_threedot.txt": listdeps_threedot,
+        "download_plus_local_paths.txt": download_plus_local_paths,
+    }
+
+
+def _get_cache_key(resolver: GomodResolver) -> str:
+    """Hash the go executable, go.mod and go.sum of the module."""
+    key = hashlib.blake2b(resolver.go_executable.encode(), digest_size=16)
+    for filename in ("go.mod", "go.sum"):
+        filepath = resolver.module_dir / filename
+        key.update(b"\0" + filename.encode() + b"\0")
+        if filepath.exists():
+            key.update(filepath.read_bytes())
+    return key.hexdigest()
+
+
+def _save_to_cache(output_dir: Path, cache_dir: Path) -> None:
+    log.info("caching results in %s", cache_dir)
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir.parent)
+    for filename in _DOWNLOAD_RESULTS:
+        shutil.copyfile(output_dir / filename, os.path.join(tmp_dir, filename))
+    # the cache dir only ever appears complete
+    os.replace(tmp_dir, cache_dir)
+
+
+def _check_vendor(resolver: GomodResolver, output_dir: Path, pretty_diff: bool) -> None:
     vendor_dir = resolver.module_dir / "vendor"
     if not vendor_dir.exists():
         log.info("vendoring dependencies")
         resolver.vendor_deps()
 
     log.info("identifying vendored dependencies")
-    vendor = get_names_and_versions(resolver.parse_vendor())
-    vendor_with_unused = get_names_and_versions(resolver.parse_vendor(drop_unused=False))
+    vendor_usage = resolver.parse_vendor_usage()
+    vendor_modules = [module for module, has_packages in vendor_usage if has_packages]
+    vendor = get_names_and_versions(vendor_modules)
+    vendor_with_unused = get_names_and_versions(module for module, _ in vendor_usage)
 
     _write_results(vendor, output_dir / "vendor.txt")
     _write_results(vendor_with_unused, output_dir / "vendor_with_unused.txt")
 
-    if vendor_diff := _diff_vendor_modules(vendor, vendor_dir):
+    vendor_module_names = {_get_name_and_version(module)[0] for module in vendor_modules}
+    if vendor_diff := _diff_vendor_modules(vendor_module_names, vendor_dir, pretty_diff):
         log.info("diffing vendor dirs: identified x actual")
         print(vendor_diff)
     else:
         log.info("diffing vendor dirs: perfect match")
 
 
-def _write_results(results: list[NameVersion], filepath: Path) -> None:
+def _write_results(results: list[str], filepath: Path) -> None:
     log.info("writing %s", filepath)
     filepath.parent.mkdir(parents=True, exist_ok=True)
-    with filepath.open("w") as f:
-        print("\n".join(map(str, results)), file=f)
+    # one join and one encode of the whole text, rather than an encode per line
+    filepath.write_bytes(("\n".join(results) + "\n").encode())
 
 
-def _get_diff(left: Iterable[str], right: Iterable[str]) -> str:
-    return "\n".join(difflib.unified_diff(sorted(left), sorted(right), lineterm=""))
+def _get_diff(left: list[str], right: list[str], pretty: bool = False) -> str:
+    """Diff two lists of unique lines, both lists must already be sorted (in the same order).
 
+    :param pretty: produce a unified diff rather than just the lines missing from either side
+    """
+    if pretty:
+        return "\n".join(difflib.unified_diff(left, right, lineterm=""))
+    return _sorted_symdiff(left, right)
 
-def _diff_vendor_modules(vendor_modules: Iterable[NameVersion], vendor_dir: Path) -> str:
-    identified_vendor_dirs = {Path(module_name) for module_name, _ in vendor_modules}
 
-    def find_unknown_vendor_dirs(vendor_subdir: Path) -> Iterator[Path]:
-        relpath_from_vendor = vendor_subdir.relative_to(vendor_dir)
-        if any(
-            relpath_from_vendor.is_relative_to(known_path) for known_path in identified_vendor_dirs
-        ):
-            return
-        child_paths = list(vendor_subdir.iterdir())
-        if any(child_path.is_file() for child_path in child_paths):
-            yield relpath_from_vendor
-        else:
-            for child_dir in filter(Path.is_dir, child_paths):
-                yield from find_unknown_vendor_dirs(child_dir)
+def _sorted_symdiff(left: list[str], right: list[str]) -> str:
+    """Get the lines missing from the right side (-line) and from the left side (+line).
+
+    Unlike difflib, works in linear time. The lines present on both sides appear in the same
+    order, so walk both lists in lockstep and report the differences between each common line.
+    """
+    left_set = set(left)
+    right_set = set(right)
+    diff_lines: list[str] = []
+    i = j = 0
+
+    while i < len(left) or j < len(right):
+        while i < len(left) and left[i] not in right_set:
+            diff_lines.append(f"-{left[i]}")
+            i += 1
+        while j < len(right) and right[j] not in left_set:
+            diff_lines.append(f"+{right[j]}")
+            j += 1
+        # both are now at the same common line (or at the end)
+        i += 1
+        j += 1
+
+    return "\n".join(diff_lines)
+
+
+# Nested path components, an empty component marks the end of a path
+_PathTrie = dict[str, "_PathTrie"]
+
+
+def _diff_vendor_modules(
+    vendor_module_names: Iterable[str], vendor_dir: Path, pretty_diff: bool = False
+) -> str:
+    identified_vendor_dirs = set(map(Path, vendor_module_names))
+
+    identified_dirs_trie: _PathTrie = {}
+    for identified_dir in identified_vendor_dirs:
+        node = identified_dirs_trie
+        for part in identified_dir.parts:
+            node = node.setdefault(part, {})
+        node[""] = {}
+
+    def find_unknown_vendor_dirs() -> Iterator[Path]:
+        prefix_len = len(str(vendor_dir)) + len(os.sep)
+
+        for dirpath, dirnames, filenames in os.walk(vendor_dir):
+            if not (relpath := dirpath[prefix_len:]):  # the vendor dir itself
+                continue
+
+            trie_node = identified_dirs_trie
+            for part in relpath.split(os.sep):
+                trie_node = trie_node.get(part, {})
+
+            if "" in trie_node:  # (a subdirectory of) an identified dir
+                dirnames.clear()
+            elif filenames:
+                yield Path(relpath)
+                dirnames.clear()
 
     actual_vendor_dirs = {p for p in identified_vendor_dirs if vendor_dir.joinpath(p).exists()}
-    actual_vendor_dirs.update(
-        unknown_dir
-        for vendor_subdir in filter(Path.is_dir, vendor_dir.iterdir())
-        for unknown_dir in find_unknown_vendor_dirs(vendor_subdir)
-    )
+    actual_vendor_dirs.update(find_unknown_vendor_dirs())
 
-    return _get_diff(map(str, identified_vendor_dirs), map(str, actual_vendor_dirs))
+    return _get_diff(
+        sorted(map(str, identified_vendor_dirs)), sorted(map(str, actual_vendor_dirs)), pretty_diff
+    )
 
 
 def _print_deptree(resolver: GomodResolver):